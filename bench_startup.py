@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# time cueek startup and count the modules it imports
+import sys
+import os
+import shutil
+import struct
+import tempfile
+from subprocess import Popen, PIPE
+from time import time
+
+CUE = """PERFORMER "Bench"
+TITLE "Startup"
+FILE "image.wav" WAVE
+  TRACK 01 AUDIO
+    TITLE "One"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "Two"
+    INDEX 01 00:01:00
+"""
+
+def mkfixture(dir):
+    frames = 44100 * 2
+    f = open(os.path.join(dir, 'image.wav'), 'wb')
+    f.write('RIFF' + struct.pack('<I', 36 + frames * 4) + 'WAVE')
+    f.write('fmt ' + struct.pack('<IHHIIHH', 16, 1, 2, 44100, 44100 * 4, 4, 16))
+    f.write('data' + struct.pack('<I', frames * 4) + '\0' * frames * 4)
+    f.close()
+    open(os.path.join(dir, 'album.cue'), 'w').write(CUE)
+
+def run(args, dir, verbose=False):
+    cmd = [sys.executable]
+    if verbose: cmd += ['-v']
+    cmd += [CUEEK] + args
+    p = Popen(cmd, cwd=dir, stdout=PIPE, stderr=PIPE, env=ENV)
+    out, err = p.communicate()
+    if p.returncode:
+        sys.exit('%s failed:\n%s' % (' '.join(args),
+            '\n'.join(err.splitlines()[-5:])))
+    return [l for l in err.splitlines() if l.startswith('import ')]
+
+def main():
+    from optparse import OptionParser
+    opt_parse = OptionParser(usage='%prog [options]')
+    opt_parse.add_option('-n', dest='runs', type='int', default=10,
+        help='number of timed runs per case [%default]')
+    opt_parse.add_option('-m', '--max-modules', dest='max', type='int',
+        help='fail if printing the layout imports more modules than this')
+    opts, args = opt_parse.parse_args()
+
+    dir = tempfile.mkdtemp(prefix='cueek-bench-')
+    ENV.update(HOME=dir, LC_ALL='C.UTF-8')
+    try:
+        mkfixture(dir)
+        cases = (('help', ['--help']), ('layout', ['-v', 'album.cue']))
+        counts = {}
+        for name, args in cases:
+            counts[name] = len(run(args, dir, True))
+            times = []
+            for x in range(opts.runs):
+                start = time()
+                run(args, dir)
+                times.append(time() - start)
+            times.sort()
+            print '%-8s modules: %4d  best: %6.1fms  median: %6.1fms' % (
+                name, counts[name], times[0] * 1000,
+                times[len(times) / 2] * 1000)
+    finally:
+        shutil.rmtree(dir)
+    if opts.max is not None and counts['layout'] > opts.max:
+        sys.exit('layout imports %d modules, limit is %d' %
+            (counts['layout'], opts.max))
+
+CUEEK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cueek.py')
+ENV = dict(os.environ)
+
+if __name__ == '__main__':
+    main()
@@ -24,20 +24,31 @@ translate:      title
 # decoders must be able to write to stdout, encoders - read from stdin
 #   [extension]
 #   decode: <commandline>   where '%f' is input file
+#   decode_range: <commandline>
+#                           same, decoding only samples from '%s' up to '%e'
 #   encode: <commandline>   where '%f' is output file
 #   rg: <commandline>       format-specific replay-gain scanner
 
+# decoded images are kept in 'dir' (if set) for reuse by later runs,
+# least recently used ones are removed to stay below 'size' megabytes
+[cache]
+dir:
+size:   2048
+
 [flac]
 decode: flac -dc %f
+decode_range: flac -dc --skip=%s --until=%e %f
 encode: flac -f -o %f -
 rg:     metaflac --add-replay-gain %f
 
 [wv]
 decode: wvunpack -o - %f
+decode_range: wvunpack --skip=%s --until=%e -o - %f
 encode: wavpack -myi -o %f -
 rg:     wvgain -a %f
 
 [ape]
+# mac cannot decode a range of samples, so there is no decode_range
 decode: mac %f - -d
 
 [play]
@@ -48,7 +59,7 @@ exit_str = '\nFinished succesfully\n'
 config_file = os.path.expanduser('~/.cueekrc')
 
 class Argv:
-    def __init__(self):
+    def __init__(self, args=None):
         from optparse import OptionParser
         opt_parse = OptionParser()
 
@@ -88,6 +99,39 @@ class Argv:
         opt_parse.add_option("-d", "--delete-files",
             action="store_false", dest="nodelete", default=True,
             help="delete source files after encoding")
+        opt_parse.add_option("-a", "--archive",
+            help="send resulting cuesheet and audio files to FILE as a tar "
+            "stream, instead of writing them to the cuesheet directory (use "
+            "'-' for stdout)", metavar="FILE")
+        opt_parse.add_option("-j", "--jobs",
+            type="int", default=1,
+            help="split single-file image using up to NUMBER decoders in "
+            "parallel (requires `decode_range' for the format)",
+            metavar="NUMBER")
+        opt_parse.add_option("-l", "--reslice",
+            action="store_true", default=False,
+            help="keep `multiple-files' cuesheet as such, rewriting it "
+            "(and the files) to `non-compliant' or, with -c, to `compliant' "
+            "layout")
+        opt_parse.add_option("--retag",
+            action="store_true", default=False,
+            help="instead of writing audio, find the files written earlier "
+            "for the cuesheet(s), then rename and tag them anew (several "
+            "cuesheets may be given)")
+        opt_parse.add_option("--check",
+            help="instead of converting, audit all cuesheets found in DIR "
+            "without decoding any audio, and print a report", metavar="DIR")
+        opt_parse.add_option("--report",
+            type="choice", choices=["json", "csv"], default="json",
+            help="with --check, write the report as json or csv (to the "
+            "FILE given with --output, if any)", metavar="FORMAT")
+        opt_parse.add_option("--serve",
+            help="run as a job server, accepting jobs as JSON lines on the "
+            "unix SOCKET", metavar="SOCKET")
+        opt_parse.add_option("--workers",
+            type="int", default=0,
+            help="with --serve or --check, run up to NUMBER jobs at once "
+            "(defaults to the number of CPUs)", metavar="NUMBER")
 
         opt_parse.set_usage('%prog [options] <in.cue>')
 
@@ -98,12 +142,15 @@ class Argv:
             "Configuration is read from `%s' file, which is created "
             "on first run or manually with `--config'." % config_file)
 
-        (self.opts, self.args) = opt_parse.parse_args()
+        (self.opts, self.args) = opt_parse.parse_args(args)
 
-        if len(self.args) != 1:
+        if len(self.args) != 1 and not (self.opts.serve or self.opts.check) \
+        and not (self.opts.retag and self.args):
             opt_parse.error('Please specify the cuesheet to process')
 
         if not self.opts.noncompl: self.opts.notrk0 = True
+        if self.opts.archive and self.opts.archive != '-':
+            self.opts.archive = os.path.abspath(self.opts.archive)
 
         if self.opts.encode : self.formats=self.opts.encode.split(',')
         else                : self.formats=['wav']
@@ -152,14 +199,18 @@ class Config:
 
 class Meta:
     def __init__(self):
-        from mutagen import File, musepack, mp3, id3
-        self.mutagen, self.mpc, self.mp3, self.id3 = (File, musepack.Musepack,
-            mp3.MP3, id3)
+        self.id3, self.id3frames = None, []
+        # mutagen modules by file extension, so that probing a file does not
+        # import every format that mutagen.File() knows of
+        self.kinds = {'flac': ('flac', 'FLAC'), 'mp3': ('mp3', 'MP3'),
+            'ogg': ('oggvorbis', 'OggVorbis'), 'opus': ('oggopus', 'OggOpus'),
+            'mpc': ('musepack', 'Musepack'), 'wv': ('wavpack', 'WavPack'),
+            'ape': ('monkeysaudio', 'MonkeysAudio'), 'm4a': ('mp4', 'MP4'),
+            'tta': ('trueaudio', 'TrueAudio'), 'ofr': ('optimfrog',
+            'OptimFROG'), 'wma': ('asf', 'ASF'), 'wav': ('wave', 'WAVE')}
         self.id3trans = {'ARTIST': 'TPE1', 'ALBUM': 'TALB', 'TITLE': 'TIT2',
             'TRACKNUMBER': 'TRCK', 'DATE': 'TDRC', 'DISCNUMBER': 'TPOS',
             'GENRE': 'TCON', 'COMMENT': 'COMM'}
-        self.id3frames = []
-        for name, frame in self.id3.Frames.items(): self.id3frames.append(name)
         self.data = {'albumartist': 'unknown', 'albumtitle': 'untitled'}
         cfg_.section = 'tags'
         self.tags_omit = cfg_.str2list('fields_skip')
@@ -167,6 +218,24 @@ class Meta:
         self.translate = ''
         if cfg_.read('translate', 1) in cfg_.case_conv:
             self.translate = '.' + cfg_.read('translate') + '()'
+    def mutagen(self, fn, easy=False):
+        kind = self.kinds.get(fn.split('.')[-1].lower())
+        if kind and not easy:
+            try:
+                module = __import__('mutagen.' + kind[0], {}, {}, [kind[1]])
+                return getattr(module, kind[1])(fn)
+            except ImportError:
+                # no such format in this mutagen version
+                if kind[0] == 'wave': return None
+            except Exception:
+                pass
+        from mutagen import File
+        return File(fn, easy=easy)
+    def load_id3(self):
+        # frame tables are only needed when tagging mp3
+        if not self.id3:
+            from mutagen import id3
+            self.id3, self.id3frames = id3, id3.Frames.keys()
     def put(self, entry, val, tn='album'):
         if isinstance(tn, int): tn = str(tn).zfill(2)
         entry = tn + entry
@@ -189,9 +258,10 @@ class Meta:
         f, ismpc, ismp3 = 3 * [None]
         if os.path.isfile(fn): f = self.mutagen(fn)
         if hasattr(f, 'info'):
+            kind = f.__class__.__module__
             tags = {}
-            if isinstance(f, self.mpc)    : ismpc = 1
-            elif isinstance(f, self.mp3)  : ismp3 = 1
+            if kind == 'mutagen.musepack'         : ismpc = 1
+            elif kind.startswith('mutagen.mp3')   : ismp3 = 1
             # collect tags
             if self.get('is_va'):
                 tags['ALBUMARTIST'] = self.get('artist')
@@ -211,6 +281,7 @@ class Meta:
                 tags['TRACK'] = tags['TRACKNUMBER']
                 if tags.has_key('DATE'): tags['YEAR'] = tags['DATE']
             if ismp3:
+                self.load_id3()
                 try: f = self.id3.ID3(fn)
                 except self.id3.ID3NoHeaderError: f = self.id3.ID3()
             # convert case if requested and write to file
@@ -254,13 +325,6 @@ class Meta:
 
 class Audio:
     def __init__(self):
-        from mutagen import version as v
-        self.use_mutagen = False
-        if v >= (1,11): self.use_mutagen = True
-        from struct import pack
-        self.pack = pack
-        from wave import Wave_read, WAVE_FORMAT_PCM
-        self.wavread, self.fmtpcm = Wave_read, WAVE_FORMAT_PCM
         self.fname, self.rdcmd, self.wrcmd = 3 * ['']
         self.frnum, self.hdr_frnum = 2 * [0]
         self.params, self.fin, self.fout = 3 * [None]
@@ -268,8 +332,11 @@ class Audio:
         self.smpl_freq = 0
     def get_params(self):
         f = meta_.mutagen(self.fname)
-        if hasattr(f, 'info') and hasattr(f.info, 'sample_rate') and \
-        self.use_mutagen:
+        use_mutagen = hasattr(f, 'info') and hasattr(f.info, 'sample_rate')
+        if use_mutagen:
+            from mutagen import version
+            use_mutagen = version >= (1,11)
+        if use_mutagen:
             f = f.info
             ch, sr = f.channels, f.sample_rate
             if hasattr(f,'bits_per_sample') : sw = f.bits_per_sample / 8
@@ -278,6 +345,9 @@ class Audio:
             else                            : sn = f.length * sr
             self.params = (ch, sw, sr, long(sn), None, None)
         else:
+            if option_.check and not self.fname.lower().endswith('.wav'):
+                exit('Failed to probe "%s" without decoding\n' % self.fname, 1)
+            self.params = None
             self.wav_rd()
             self.params = self.fin.getparams()
             self.fin.close()
@@ -285,10 +355,12 @@ class Audio:
             subp_.wait_for_child(kill=1)
         if not self.smpl_freq: self.smpl_freq = self.params[2]
     def gen_hdr(self): # taken from `wave' module
+        from struct import pack
+        from wave import WAVE_FORMAT_PCM
         par = self.params
         len = self.hdr_frnum * par[0] * par[1]
-        hdr = 'RIFF' + self.pack('<l4s4slhhllhh4sl', 36 + len, 'WAVE', 'fmt ',
-            16, self.fmtpcm, par[0], par[2], par[0] * par[2] * par[1],
+        hdr = 'RIFF' + pack('<l4s4slhhllhh4sl', 36 + len, 'WAVE', 'fmt ',
+            16, WAVE_FORMAT_PCM, par[0], par[2], par[0] * par[2] * par[1],
             par[0] * par[1], par[1] * 8, 'data', len)
         return hdr
     def wr_chunks(self):
@@ -301,27 +373,57 @@ class Audio:
             self.fout.write(frames)
         frames = self.fin.readframes(self.frnum%step) # leftovers
         self.fout.write(frames)
-    def wav_rd(self):
+    def can_rd_range(self):
+        ext = self.fname.split('.')[-1].lower()
+        cfg_.section = ext.encode(encoding)
+        if ext == 'wav' or cfg_.read('decode_range', 1): return 1
+        f = cache_.get(self.fname, cfg_.get_cmdline('decode', [self.fname]))
+        if f: f.close()
+        return f
+    def wav_rd(self, start=0, end=0):
+        from wave import Wave_read
         ext = self.fname.split('.')[-1].lower()
         cfg_.section = ext.encode(encoding)
         r = tryfile(self.fname, 'rb')
         if ext != 'wav' and cfg_.read('decode'):
             r.close()
+            rangecmd = []
+            if end and cfg_.read('decode_range', 1):
+                rangecmd = [x.replace('%s', str(start)).replace('%e',
+                    str(end)) for x in cfg_.get_cmdline('decode_range',
+                    [self.fname])]
             self.rdcmd = cfg_.get_cmdline('decode', [self.fname])
-            subp_.exec_child()
-            r = subp_.rdproc.stdout
+            r = cache_.get(self.fname, self.rdcmd)
+            if not r and rangecmd:
+                self.rdcmd, start = rangecmd, 0
+                subp_.exec_child()
+                r = subp_.rdproc.stdout
+            elif not r:
+                subp_.exec_child()
+                r = cache_.tee(subp_.rdproc.stdout, self.fname, self.rdcmd)
         try:
-            r = self.wavread(r)
+            r = Wave_read(r)
         except EOFError:
             subp_.wait_for_child()
-            exit(errstr, 1)
+            exit('Failed to read "%s"\n' % self.fname, 1)
+        # the header of the output is made from the params probed before
+        if self.params and r.getparams()[:3] != self.params[:3]:
+            par = r.getparams()
+            if subp_.rdproc: subp_.rdproc.stdout.close()
+            subp_.wait_for_child(kill=1)
+            exit('Decoded "%s" is %i channels, %i bit, %i Hz, not as probed '
+                '(%i channels, %i bit, %i Hz)\n' % ((self.fname, par[0],
+                par[1] * 8, par[2], self.params[0], self.params[1] * 8,
+                self.params[2])), 1)
+        if start: r.setpos(start)
         self.fin = r
     def wav_wr(self):
         cfg_.section = argv_.format
+        fn = sink_.path(self.fname)
         if argv_.format == 'wav':
-            w = tryfile(self.fname, 'wb')
+            w = tryfile(fn, 'wb')
         elif cfg_.read('encode'):
-            self.wrcmd = cfg_.get_cmdline('encode', [self.fname])
+            self.wrcmd = cfg_.get_cmdline('encode', [fn])
             subp_.exec_child('wr')
             w = subp_.wrproc.stdin
         self.fout = w
@@ -349,8 +451,11 @@ class Cue:
         (self.pregap, self.trackzero_present, self.is_compl, self.is_noncompl,
             self.is_singlefile, self.is_va) = 6 * [0]
         self.charmap, self.sheet, self.ref_file = encoding, [], ''
+        self.name, self.sources, self.bounds, self.duration = '', [], [], 0
+        self.confidence, self.overruns = None, []
     def probe(self, fn):
         f = tryfile(fn)
+        self.name = os.path.basename(fn)
         size = os.path.getsize(fn)
         if size >= long(16384):
             _f = meta_.mutagen(fn)
@@ -362,11 +467,21 @@ class Cue:
         else:
             if option_.charmap: self.charmap = option_.charmap
             else:
+                _f = tryfile(fn)
+                data = _f.read()
+                _f.close()
+                try:
+                    # no need to load chardet for a plain ascii one
+                    data.decode('ascii')
+                    detected = {'encoding': 'ascii', 'confidence': 1.0}
+                except UnicodeDecodeError:
+                    detected = None
                 try:
-                    import chardet
-                    _f = tryfile(fn)
-                    self.charmap = chardet.detect(_f.read())['encoding']
-                    _f.close()
+                    if not detected:
+                        import chardet
+                        detected = chardet.detect(data)
+                    self.charmap = detected['encoding']
+                    self.confidence = detected['confidence']
                 except ImportError:
                     pass
             self.sheet = [line.decode(self.charmap) for line in f]
@@ -380,7 +495,7 @@ class Cue:
         lst[2] = m.replace('"', "''")
         return (m, ''.join(lst))
     def parse(self):
-        trknum = 1
+        trknum, file_start, framenum = 1, 0, 0
         for line in [s.lstrip() for s in self.sheet]:
             tn = 'album'
             if re.search('^PERFORMER\s+"', line, re.I):
@@ -404,10 +519,12 @@ class Cue:
                 ref_file = line.split('"')[1]
 
                 if self.ref_file: ref_file = self.ref_file
-                aud_.fname = ref_file
-                aud_.get_params()
-
-                framenum = aud_.params[3]
+                if self.sources:
+                    framenum = self.duration
+                else:
+                    aud_.fname = ref_file
+                    aud_.get_params()
+                    framenum = aud_.params[3]
                 if not meta_.get('trck', 1):
                     for x in 0, 1:
                         meta_.put('name', ref_file, x)
@@ -422,6 +539,7 @@ class Cue:
                     meta_.put('apos', abs_pos, 0)
                 abs_pos = meta_.get('apos', trknum-1) + framenum
                 meta_.put('apos', abs_pos, trknum)
+                file_start = abs_pos - framenum
             elif re.search('^TRACK\s+\d+\s+AUDIO', line, re.I):
                 meta_.put('trck', 1, trknum)
             elif aud_.linehas('^PREGAP\s+', line):
@@ -432,6 +550,8 @@ class Cue:
                 tn = trknum
                 if idx_num > 1: tn = trknum - 1
                 meta_.put('idx%.2u' % idx_num, idx_pos, tn)
+                meta_.put('abs%.2u' % idx_num, file_start + idx_pos, tn)
+                if idx_pos > framenum: self.overruns.append((tn, idx_num))
                 if idx_num == 1: trknum += 1
         if not meta_.get('lgth', 1):
             exit('Failed to get the length of referenced file', 1)
@@ -634,15 +754,20 @@ class Cue:
         meta_.put('cuesheet', cue)
         cue = cue.encode(encoding)
         cutstr = 10 * '- ' + '8< ' + 10 * '- ' + '\n'
-        if option_.output:
+        if option_.archive:
+            fn = option_.output or os.path.splitext(self.name)[0] + '.cue'
+            sink_.add_data(os.path.basename(fn), cue)
+        elif option_.output:
             result = tryfile(option_.output, 'w')
             result.write(cue)
             result.close()
-        else:
+        elif not option_.retag:
             pollute('\nCuesheet:\n\n' + cutstr)
             print cue
             pollute(cutstr)
 class Files:
+    def __init__(self):
+        self.list, self.lgth, self.replaced, self.swaps = [], [], [], []
     def write(self):
         n = meta_.get('numoftracks')
         if not argv_.tracks: argv_.tracks = range(n+1)
@@ -650,37 +775,33 @@ class Files:
             pollute('\nWriting %s files...\n\n' % (argv_.format))
             self.list, self.lgth = [], []
             if meta_.get('is_singlefile'):
-                _if = meta_.get('name', 1)
-                aud_.fname = _if
-                aud_.wav_rd()
+                aud_.fname = meta_.get('name', 1)
+                if option_.jobs > 1 and not cue_.sources and \
+                aud_.can_rd_range():
+                    self.split_parallel()
+                    self.apply_rg()
+                    continue
+                elif option_.jobs > 1 and cue_.sources:
+                    pollute('WARNING: -j is not used when reslicing\n', 1)
+                elif option_.jobs > 1:
+                    pollute("WARNING: no `decode_range' to read parts of "
+                        '"%s", using a single decoder\n' % aud_.fname, 1)
+                if cue_.sources: aud_.fin = Chain(cue_.sources)
+                else: aud_.wav_rd()
                 for x in xrange(n):
                     if meta_.get('lgth', x):
-                        if meta_.get('idx01', 1) and not option_.notrk0: t = x
-                        else: t = x+1
                         if x > argv_.tracks[-1]:
                             aud_.fin.close()
+                            # let the decoder finish, if it fills the cache
+                            if cache_.fout: subp_.wait_for_child()
                             exit(exit_str)
-                        elif x in argv_.tracks:
-                            aud_.fname = meta_.filename(x)
-                            aud_.wav_wr()
-                            self.list.append(aud_.fname)
-                        else:
-                            aud_.fname = os.devnull
-                            aud_.fout = tryfile(aud_.fname, 'wb')
-                        scurr = meta_.get('apos', x-1)
-                        snext = meta_.get('apos', x)
-                        aud_.hdr_frnum = aud_.frnum = snext - scurr
-                        statstr = '%s[%s:%s] > %s\n' % \
-                            (_if, aud_.getlength(scurr,'.'),
-                            aud_.getlength(snext,'.'), aud_.fname)
-                        pollute(statstr, 1)
-
-                        aud_.wr_chunks()
-                        aud_.fout.close()
-                        subp_.wait_for_child('wr')
-                        meta_.tag(aud_.fname, x)
+                        self.split(x)
+                        if x in argv_.tracks:
+                            self.list.append(sink_.path(aud_.fname))
+                            sink_.add(aud_.fname)
                 aud_.fin.close()
                 subp_.wait_for_child()
+                self.swap()
             else:
                 _of = meta_.filename(1)
                 aud_.fname = _of
@@ -711,9 +832,181 @@ class Files:
 
                 aud_.fout.close()
                 subp_.wait_for_child('wr')
-                meta_.tag(_of)
-                self.list = [_of]
+                meta_.tag(sink_.path(_of))
+                sink_.add(_of)
+                self.list = [sink_.path(_of)]
             self.apply_rg()
+    def retag(self):
+        n = meta_.get('numoftracks')
+        tracks = argv_.tracks or range(n+1)
+        skipped = []
+        for argv_.format in argv_.formats:
+            pollute('\nRetagging %s files...\n\n' % (argv_.format))
+            if meta_.get('is_singlefile'):
+                wanted = [x for x in xrange(n)
+                    if meta_.get('lgth', x) and x in tracks]
+            else:
+                wanted = [0]
+            found = self.find(wanted)
+            for x in wanted:
+                if x not in found:
+                    pollute('Nothing found for %s\n' % self.target(x), 1)
+            moves = [(x, found[x], self.target(x)) for x in sorted(found)]
+            # never rename over a file that is not being renamed itself
+            olds = [old for (x, old, new) in moves]
+            for (x, old, new) in moves[:]:
+                if old != new and os.path.exists(new) and new not in olds:
+                    pollute('ERROR: "%s" exists, not renaming "%s"\n' % \
+                        (new, old), 1)
+                    moves.remove((x, old, new))
+                    skipped.append(old)
+            # in two steps, so that files may swap names
+            for (x, old, new) in moves:
+                if old != new: os.rename(old, '.cueek-' + new)
+            for (x, old, new) in moves:
+                if old != new:
+                    os.rename('.cueek-' + new, new)
+                    pollute('%s > %s\n' % (old, new), 1)
+                meta_.tag(new, x)
+        argv_.format = argv_.formats[0]
+        if skipped: exit('Failed to retag %i files\n' % len(skipped), 1)
+    def target(self, x):
+        if meta_.get('is_singlefile'): return meta_.filename(x)
+        return meta_.filename(1)
+    def find(self, wanted):
+        """Map track numbers to the files written for them earlier, by the
+        track number in their tags, or else (for files without tags) under
+        the name they would get now. Files tagged as a part of some other
+        album are left alone"""
+        found, untagged = {}, []
+        skip = []
+        if not cue_.sources:
+            skip = [meta_.get('name', x) for x in
+                xrange(meta_.get('numoftracks')) if meta_.get('name', x)]
+        for fn in sorted(os.listdir('.')):
+            fn = fn.decode(encoding)
+            if fn in skip or \
+            not fn.lower().endswith('.' + argv_.format.lower()):
+                continue
+            x = self.tracknumber(fn)
+            if x is None: untagged.append(fn)
+            elif x in wanted and x not in found: found[x] = fn
+        for x in wanted:
+            if x not in found and self.target(x) in untagged:
+                found[x] = self.target(x)
+        return found
+    def tracknumber(self, fn):
+        """Track number from the tags of the file, 0 for a merged one, -1
+        for one of another album"""
+        f = meta_.mutagen(fn, easy=True)
+        try:
+            x = int(f['tracknumber'][0].split('/')[0])
+        except (KeyError, IndexError, ValueError, TypeError):
+            if not (f and 'cuesheet' in f): return None
+            x = 0
+        if not self.ours(f): return -1
+        return x
+    def ours(self, f):
+        """Whether album and artist, where tagged, are those of the cuesheet,
+        letter case aside, as it may have been translated"""
+        artists = [meta_.get('artist')] + [meta_.get('artist', x)
+            for x in xrange(meta_.get('numoftracks'))]
+        for (key, vals) in (('album', [meta_.get('title')]),
+            ('artist', artists), ('albumartist', artists)):
+            vals = [v.lower() for v in vals if v]
+            tagged = [v.lower() for v in f.get(key, [])]
+            if tagged and not [v for v in tagged if v in vals]: return False
+        return True
+    def split(self, x):
+        """Write track x of the single-file image, reading it from aud_.fin"""
+        _if = meta_.get('name', 1)
+        fname = meta_.filename(x)
+        if x in argv_.tracks:
+            aud_.fname = fname
+            # a source being resliced is replaced only once all is written
+            if fname in cue_.sources and not sink_.tmpdir:
+                aud_.fname = '.cueek-' + fname
+            aud_.wav_wr()
+        else:
+            aud_.fname = os.devnull
+            aud_.fout = tryfile(aud_.fname, 'wb')
+        scurr = meta_.get('apos', x-1)
+        snext = meta_.get('apos', x)
+        aud_.hdr_frnum = aud_.frnum = snext - scurr
+        out = os.devnull
+        if x in argv_.tracks: out = fname
+        statstr = '%s[%s:%s] > %s\n' % \
+            (_if, aud_.getlength(scurr,'.'),
+            aud_.getlength(snext,'.'), out)
+        if cue_.bounds:
+            statstr = ' + '.join(['%s[%s:%s]' % (name,
+                aud_.getlength(max(scurr, start) - start, '.'),
+                aud_.getlength(min(snext, end) - start, '.'))
+                for (start, end, name) in cue_.bounds
+                if start < snext and end > scurr]) + ' > %s\n' % out
+        pollute(statstr, 1)
+
+        aud_.wr_chunks()
+        aud_.fout.close()
+        subp_.wait_for_child('wr')
+        if x in argv_.tracks:
+            meta_.tag(sink_.path(aud_.fname), x)
+            if aud_.fname != fname:
+                self.swaps.append((aud_.fname, fname))
+                aud_.fname = fname
+    def swap(self):
+        for (tmp, fname) in self.swaps:
+            os.rename(tmp, fname)
+            self.replaced.append(fname)
+        self.swaps = []
+    def ranges(self, tracks):
+        """Partition tracks into contiguous groups of about the same length,
+        one per decoder"""
+        if not tracks: return []
+        total = sum([meta_.get('lgth', x) for x in tracks])
+        groups, acc = [[]], 0
+        for x in tracks:
+            if groups[-1] and acc >= total * len(groups) / option_.jobs:
+                groups.append([])
+            groups[-1].append(x)
+            acc += meta_.get('lgth', x)
+        return groups
+    def split_parallel(self):
+        """Same as the sequential split, but every group of tracks is decoded
+        and written by a forked copy of ourselves"""
+        _if = meta_.get('name', 1)
+        tracks = [x for x in xrange(meta_.get('numoftracks'))
+            if meta_.get('lgth', x) and x in argv_.tracks]
+        pids = []
+        sys.stdout.flush()
+        for group in self.ranges(tracks):
+            pid = os.fork()
+            if not pid:
+                code = 1
+                try:
+                    aud_.fname = _if
+                    aud_.wav_rd(meta_.get('apos', group[0]-1),
+                        meta_.get('apos', group[-1]))
+                    for x in xrange(group[0], group[-1]+1):
+                        if meta_.get('lgth', x): self.split(x)
+                    aud_.fin.close()
+                    subp_.wait_for_child()
+                    code = 0
+                except SystemExit, err:
+                    code = err.code
+                except Exception:
+                    from traceback import print_exc
+                    print_exc()
+                finally:
+                    os._exit(code)
+            pids.append(pid)
+        failed = [pid for pid in pids if os.waitpid(pid, 0)[1]]
+        if failed: exit('%i of %i decoders failed\n' % \
+            (len(failed), len(pids)), 1)
+        for x in tracks:
+            aud_.fname = meta_.filename(x)
+            self.list.append(sink_.path(aud_.fname))
+            sink_.add(aud_.fname)
     def apply_rg(self):
         cfg_.section = argv_.format
         if not option_.norg and cfg_.read('rg'):
@@ -724,20 +1017,187 @@ class Files:
             aud_.rdcmd = cfg_.get_cmdline('rg', self.list)
             subp_.exec_child()
             subp_.wait_for_child()
+        sink_.flush()
     def rm(self):
         pollute('\nDeleting files...\n\n')
         n = meta_.get('numoftracks')
-        for x in xrange(1, n):
-            if meta_.get('name', x):
-                f = meta_.get('name', x)
-                pollute('<<< %s\n' % f, 1)
-                os.remove(f)
+        files = [x for x in cue_.sources if x not in self.replaced]
+        if not cue_.sources:
+            files = [meta_.get('name', x) for x in xrange(1, n)
+                if meta_.get('name', x)]
+        for f in files:
+            pollute('<<< %s\n' % f, 1)
+            os.remove(f)
 
-class SubProc:
+class Chain:
+    """Reader of several files, one after another, as a single image"""
+    def __init__(self, files):
+        self.files, self.fin = list(files), None
+    def readframes(self, n):
+        data, size = '', aud_.params[0] * aud_.params[1]
+        while n and (self.fin or self.files):
+            if not self.fin:
+                fname, fin = aud_.fname, aud_.fin
+                aud_.fname = self.files.pop(0)
+                aud_.wav_rd()
+                self.fin = aud_.fin
+                aud_.fname, aud_.fin = fname, fin
+            frames = self.fin.readframes(n)
+            data += frames
+            n -= len(frames) / size
+            if n: self.close() # got to the end of the file
+        return data
+    def close(self):
+        if self.fin:
+            self.fin.close()
+            subp_.wait_for_child()
+        self.fin = None
+
+class Sink:
+    """Destination of the written files: either the current directory, or a
+    tar stream, in which case the files are kept in a temporary directory
+    until tagging and replay gain are done with them"""
     def __init__(self):
-        from subprocess import Popen, PIPE
+        self.tar, self.fout, self.tmpdir, self.pending = None, None, '', []
+        self.pid = 0
+    def owned(self):
+        # forked writers leave the stream to the process that opened it
+        return self.tar and self.pid == os.getpid()
+    def open(self):
+        if option_.archive and not self.tar:
+            from tarfile import open as taropen
+            from tempfile import mkdtemp
+            if option_.archive == '-': self.fout = sys.stdout
+            else: self.fout = tryfile(option_.archive, 'wb')
+            self.tar = taropen(fileobj=self.fout, mode='w|')
+            self.tmpdir = mkdtemp('', 'cueek')
+            self.pid = os.getpid()
+    def path(self, fn):
+        if self.tmpdir: fn = os.path.join(self.tmpdir, fn)
+        return fn
+    def add(self, fn):
+        self.pending.append(fn)
+        # replay gain scanners need all the files at once
+        cfg_.section = argv_.format
+        if option_.norg or not cfg_.read('rg', 1): self.flush()
+    def add_data(self, fn, data):
+        from tarfile import TarInfo
+        from StringIO import StringIO
+        from time import time
+        self.open()
+        info = TarInfo(fn.encode(encoding))
+        info.size, info.mtime = len(data), time()
+        self.tar.addfile(info, StringIO(data))
+    def flush(self):
+        if self.owned():
+            for fn in self.pending:
+                pollute('>>> %s\n' % fn, 1)
+                self.tar.add(self.path(fn), fn.encode(encoding))
+                os.remove(self.path(fn))
+        self.pending = []
+    def close(self, abort=0):
+        if self.owned():
+            if not abort:
+                self.flush()
+                self.tar.close()
+            self.fout.flush()
+            if self.fout != sys.stdout: self.fout.close()
+            from shutil import rmtree
+            rmtree(self.tmpdir, True)
+        self.tar, self.tmpdir, self.pending = None, '', []
+
+class Cache:
+    """Local store of decoded images, keyed by the source file and the
+    decoder command line. While the decoder runs, whatever is read from it
+    is also spilled to a partial file, which is put in place once the
+    decoder has finished successfully"""
+    def __init__(self):
+        self.dir, self.limit, self.ready = '', 0, 0
+        self.fin, self.fout, self.name, self.part = None, None, '', ''
+    def setup(self):
+        if not self.ready:
+            self.ready = 1
+            cfg_.section = 'cache'
+            self.dir = os.path.expanduser(cfg_.read('dir', 1))
+            try:
+                self.limit = long(cfg_.read('size', 1) or 0) * 1048576
+            except ValueError:
+                exit('Config file: cache size must be in megabytes\n', 1)
+            if self.dir and not os.path.isdir(self.dir):
+                try:
+                    os.makedirs(self.dir)
+                except OSError, err:
+                    exit('Failed to create cache directory "%s": %s\n' % \
+                        (self.dir, err.strerror), 1)
+            if self.dir: self.sweep()
+        return self.dir
+    def sweep(self):
+        """Remove partial files left by runs killed while decoding. Those
+        still being written are touched with every chunk, so anything
+        untouched for an hour is stale"""
+        from time import time
+        for fn in os.listdir(self.dir):
+            if fn.startswith('cueek') and fn.endswith('.part'):
+                fn = os.path.join(self.dir, fn)
+                try:
+                    if os.stat(fn).st_mtime < time() - 3600: os.remove(fn)
+                except OSError:
+                    pass
+    def path(self, fn, cmd):
+        from hashlib import sha1
+        st = os.stat(fn)
+        key = '\0'.join([os.path.realpath(fn), str(st.st_size),
+            str(st.st_mtime)] + cmd)
+        return os.path.join(self.dir,
+            sha1(key.encode(encoding)).hexdigest() + '.wav')
+    def get(self, fn, cmd):
+        f = None
+        if self.setup():
+            cached = self.path(fn, cmd)
+            if os.path.isfile(cached):
+                os.utime(cached, None)
+                f = tryfile(cached, 'rb')
+        return f
+    def tee(self, fin, fn, cmd):
+        if not self.setup(): return fin
         from tempfile import mkstemp
-        self.run, self.pipe, self.mktmp = Popen, PIPE, mkstemp
+        self.name = self.path(fn, cmd)
+        fd, self.part = mkstemp('.part', 'cueek', self.dir)
+        self.fin, self.fout = fin, os.fdopen(fd, 'wb')
+        return self
+    def read(self, n=-1):
+        data = self.fin.read(n)
+        self.fout.write(data)
+        return data
+    def drain(self):
+        if self.fout:
+            while self.read(65536): pass
+    def done(self, keep=0):
+        if self.fout:
+            self.fout.close()
+            if keep:
+                os.rename(self.part, self.name)
+                self.evict()
+            else:
+                os.remove(self.part)
+        self.fin, self.fout = None, None
+    def evict(self):
+        if not self.limit: return
+        files, total = [], 0
+        for fn in os.listdir(self.dir):
+            if fn.endswith('.wav'):
+                fn = os.path.join(self.dir, fn)
+                st = os.stat(fn)
+                files.append((st.st_mtime, st.st_size, fn))
+                total += st.st_size
+        files.sort()
+        while files and total > self.limit:
+            mtime, size, fn = files.pop(0)
+            os.remove(fn)
+            total -= size
+
+class SubProc:
+    def __init__(self):
         self.rdproc, self.rdlog, self.wrproc, self.wrlog = 4 * [None]
         self.rddump, self.wrdump = 2 * [-1]
         self.cmd = ''
@@ -746,13 +1206,15 @@ class SubProc:
             (' '.join(self.cmd), str.decode(encoding))
         exit(s, 1)
     def exec_child(self, mode='rd'):
+        from subprocess import Popen, PIPE
+        from tempfile import mkstemp
         if mode == 'rd':
             pipe, self.cmd = 'out', aud_.rdcmd
-            self.rddump, self.rdlog = self.mktmp('rdlog', 'cueek')
+            self.rddump, self.rdlog = mkstemp('rdlog', 'cueek')
         else:
             pipe, self.cmd = 'in', aud_.wrcmd
-            self.wrdump, self.wrlog = self.mktmp('wrlog', 'cueek')
-        p = 'self.run(self.cmd, std%s=self.pipe, stderr=self.%sdump)' % \
+            self.wrdump, self.wrlog = mkstemp('wrlog', 'cueek')
+        p = 'Popen(self.cmd, std%s=PIPE, stderr=self.%sdump)' % \
             (pipe, mode)
         try:
             proc = eval(p)
@@ -764,6 +1226,7 @@ class SubProc:
         retcode = 0
         if mode == 'rd' : (p, fd, fn) = (self.rdproc, self.rddump, self.rdlog)
         else            : (p, fd, fn) = (self.wrproc, self.wrdump, self.wrlog)
+        if mode == 'rd' and not kill: cache_.drain()
         if p:
             retcode = p.wait()
             if p.stdin : p.stdin.close()
@@ -777,8 +1240,229 @@ class SubProc:
             os.remove(fn)
         except OSError:
             pass
+        if mode == 'rd' :
+            self.rdproc, self.rddump = None, -1
+            cache_.done(not (retcode or kill))
+        else            : self.wrproc, self.wrdump = None, -1
         if retcode and not kill: self.bailout(errstr)
 
+class Server:
+    """Job server: reads JSON lines from clients connected to a unix socket
+    and answers each with a JSON line. Accepted requests are
+
+        {"submit": {"cue": "/path/to.cue", "encode": "flac", "write": true,
+            "tracks": "3-5", ...}, "priority": 0}
+        {"status": <job id>}, or {"status": null} for all jobs
+
+    where the job keys are long command line options. Every job runs in a
+    process forked from the server, which has mutagen and the config
+    already loaded, and its messages are kept in a log for reporting
+    progress"""
+    def __init__(self):
+        import socket, json
+        from stat import S_ISSOCK
+        self.json, self.socket = json, socket
+        self.jobs, self.queue, self.running, self.clients = {}, [], {}, {}
+        self.workers = option_.workers
+        if not self.workers:
+            from multiprocessing import cpu_count
+            self.workers = cpu_count()
+        # have mutagen import all of its formats before forking
+        meta_.mutagen(os.devnull)
+        meta_.load_id3()
+        self.path = os.path.abspath(option_.serve)
+        if os.path.exists(self.path) and S_ISSOCK(os.stat(self.path).st_mode):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(self.path)
+        except socket.error, err:
+            exit('Failed to bind "%s": %s\n' % (self.path, err.args[-1]), 1)
+        self.sock.listen(5)
+    def loop(self):
+        from select import select
+        pollute('Listening on %s\n' % self.path, 1)
+        try:
+            while 1:
+                r = select([self.sock] + self.clients.keys(), [], [], 0.5)[0]
+                for c in r:
+                    if c == self.sock:
+                        self.clients[self.sock.accept()[0]] = ''
+                    else:
+                        self.receive(c)
+                self.reap()
+                self.schedule()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.sock.close()
+            os.remove(self.path)
+            for job in self.jobs.values():
+                if os.path.exists(job['log']): os.remove(job['log'])
+    def receive(self, c):
+        try:
+            data = c.recv(4096)
+            self.clients[c] += data
+            while '\n' in self.clients[c]:
+                line, self.clients[c] = self.clients[c].split('\n', 1)
+                try:
+                    reply = self.handle(self.json.loads(line))
+                except (ValueError, TypeError, AttributeError), err:
+                    reply = {'error': 'Malformed request: %s' % err}
+                c.sendall(self.json.dumps(reply) + '\n')
+        except self.socket.error:
+            # the client is gone, the jobs it submitted are not
+            data = ''
+        if not data:
+            c.close()
+            del self.clients[c]
+    def handle(self, req):
+        if 'submit' in req:
+            return self.submit(req['submit'], int(req.get('priority', 0)))
+        elif 'status' in req:
+            if req['status'] is None:
+                return {'jobs': [self.status(x) for x in sorted(self.jobs)]}
+            elif req['status'] in self.jobs:
+                return self.status(req['status'])
+            return {'error': 'No such job: %s' % req['status']}
+        return {'error': 'Unknown request'}
+    def submit(self, spec, priority):
+        from heapq import heappush
+        from tempfile import mkstemp
+        if not spec.get('cue'): return {'error': 'No cuesheet given'}
+        args = []
+        for (key, val) in spec.iteritems():
+            if key in ('config', 'serve', 'workers'):
+                return {'error': 'Option not allowed in a job: %s' % key}
+            if key == 'cue' or val in (False, None): continue
+            args.append('--' + key.encode(encoding))
+            if val is not True: args.append(unicode(val).encode(encoding))
+        args.append(os.path.abspath(spec['cue'].encode(encoding)))
+        try:
+            Argv(args)
+        except SystemExit:
+            return {'error': 'Invalid job options: %s' % ' '.join(args)}
+        id = len(self.jobs) + 1
+        fd, log = mkstemp('.log', 'cueek')
+        os.close(fd)
+        self.jobs[id] = {'id': id, 'cue': args[-1], 'args': args, 'log': log,
+            'priority': priority, 'state': 'queued', 'code': None}
+        heappush(self.queue, (-priority, id))
+        return {'id': id}
+    def schedule(self):
+        from heapq import heappop
+        while self.queue and len(self.running) < self.workers:
+            job = self.jobs[heappop(self.queue)[1]]
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if not pid:
+                self.sock.close()
+                for c in self.clients: c.close()
+                fd = os.open(job['log'], os.O_WRONLY)
+                os.dup2(fd, 1)
+                os.dup2(fd, 2)
+                os.close(fd)
+                code = 1
+                try:
+                    run(job['args'])
+                except SystemExit, err:
+                    code = err.code
+                except Exception:
+                    from traceback import print_exc
+                    print_exc()
+                finally:
+                    os._exit(code)
+            job['state'] = 'running'
+            self.running[pid] = job
+    def reap(self):
+        while self.running:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid: break
+            job = self.running.pop(pid)
+            job['code'] = status >> 8
+            if status: job['state'] = 'failed'
+            else: job['state'] = 'done'
+    def status(self, id):
+        job = self.jobs[id]
+        result = dict([(x, job[x]) for x in
+            ('id', 'cue', 'priority', 'state', 'code')])
+        log = open(job['log'])
+        lines = [x for x in log.read().splitlines() if x.strip()]
+        log.close()
+        result['progress'] = ''
+        if lines: result['progress'] = lines[-1].decode(encoding, 'replace')
+        return result
+
+def check(fn):
+    """Audit a single cuesheet, without decoding any audio"""
+    from StringIO import StringIO
+    result = {'cue': fn, 'type': '', 'va': 0, 'tracks': 0, 'missing': [],
+        'overruns': [], 'charset': '', 'confidence': None, 'aligned': None,
+        'error': ''}
+    reset()
+    # keep the messages of the failures for the report
+    sys.stderr = StringIO()
+    try:
+        os.chdir(os.path.split(fn)[0])
+        cue_.probe(fn)
+        result['charset'] = cue_.charmap
+        result['confidence'] = cue_.confidence
+        for line in [s.lstrip() for s in cue_.sheet]:
+            if re.search('^FILE\s+"', line, re.I) and not cue_.ref_file:
+                ref_file = line.split('"')[1]
+                if not os.path.isfile(ref_file):
+                    result['missing'].append(ref_file)
+        if not result['missing']:
+            cue_.parse()
+            n = meta_.get('numoftracks')
+            sector = aud_.smpl_freq / 75
+            result['type'], result['va'] = cue_.type, cue_.is_va
+            result['tracks'] = n - 1
+            result['overruns'] = ['%.2u/%.2u' % x for x in cue_.overruns]
+            result['aligned'] = not [x for x in xrange(1, n)
+                if meta_.get('name', x) and meta_.get('lgth', x) % sector]
+    except SystemExit:
+        result['error'] = sys.stderr.getvalue().replace('ERROR: ', '').strip()
+    except Exception, err:
+        result['error'] = '%s' % err
+    sys.stderr = sys.__stderr__
+    return result
+
+def audit(top):
+    from multiprocessing import Pool
+    cues = []
+    for (path, dirs, files) in os.walk(os.path.abspath(top)):
+        for fn in files:
+            if fn.lower().endswith('.cue'):
+                cues.append(os.path.join(path, fn).decode(encoding))
+    pool = Pool(option_.workers or None)
+    report = pool.map(check, sorted(cues), 16)
+    pool.close()
+    pool.join()
+    if option_.output: out = tryfile(option_.output, 'wb')
+    else: out = sys.stdout
+    fields = ['cue', 'type', 'va', 'tracks', 'missing', 'overruns',
+        'charset', 'confidence', 'aligned', 'error']
+    if option_.report == 'csv':
+        from csv import writer
+        w = writer(out)
+        w.writerow(fields)
+        for r in report:
+            row = []
+            for val in [r[x] for x in fields]:
+                if isinstance(val, list): val = ';'.join(val)
+                elif val is None: val = ''
+                row.append(unicode(val).encode(encoding))
+            w.writerow(row)
+    else:
+        from json import dump
+        dump(report, out, indent=1, sort_keys=True)
+        out.write('\n')
+    if out != sys.stdout: out.close()
+    bad = [r for r in report if r['error'] or r['missing'] or r['overruns']]
+    exit('Checked %i cuesheets, %i with problems\n' % (len(report), len(bad)))
+
 def config(option, opt, value, parser=None):
     cfg_file = open(config_file, 'w')
     cfg_file.write(DFLT_CFG)
@@ -793,6 +1477,8 @@ def tryfile(fn, mode='r'):
         exit(errstr, 1)
     return f
 
+sink_ = Sink()
+cache_ = Cache()
 argv_ = Argv()
 option_ = argv_.opts
 subp_ = SubProc()
@@ -808,6 +1494,8 @@ def pollute(s, override=0):
         sys.stderr.flush()
 
 def exit(s, die=0):
+    sink_.close(die)
+    cache_.done()
     if die:
         s = 'ERROR: ' + s
         pollute(s, 1)
@@ -816,24 +1504,106 @@ def exit(s, die=0):
         pollute(s)
         sys.exit(0)
 
+def reslice():
+    """Turn the `multiple-files' cue, which modify() has just merged, into a
+    `single-file' one, that refers to the source files read in a row, with
+    index positions exact to a sample"""
+    global meta_, cue_
+    n = meta_.get('numoftracks')
+    bounds, sources = [], []
+    for x in xrange(n):
+        name = meta_.get('name', x)
+        if name and meta_.get('lgth', x) and name not in sources:
+            end = meta_.get('apos', x)
+            bounds.append((end - meta_.get('lgth', x), end, name))
+            sources.append(name)
+    keep = [(k, v) for (k, v) in meta_.data.items() if
+        re.search('(artist|title|comment|abs\d\d)$', k)]
+    sheet, name, duration = cue_.sheet, cue_.name, meta_.get('duration')
+    cue_type = cue_.type
+    meta_, cue_ = Meta(), Cue()
+    cue_.sheet, cue_.name = sheet, name
+    cue_.sources, cue_.bounds, cue_.duration = sources, bounds, duration
+    cue_.parse()
+    # report the layout of the cuesheet given, not of the merged one
+    cue_.type = cue_type
+    for (k, v) in keep:
+        meta_.data[re.sub('abs(\d\d)$', 'idx\\1', k)] = v
+    cue_.modify()
+    # the sources left unwritten would no longer match either cuesheet
+    if option_.tracks and not option_.nowrite and not option_.archive:
+        for argv_.format in argv_.formats:
+            for x in argv_.tracks:
+                if x < meta_.get('numoftracks') and \
+                meta_.filename(x) in sources:
+                    exit('Reslicing only some of the tracks would overwrite '
+                        '"%s"\n' % meta_.filename(x), 1)
+        argv_.format = argv_.formats[0]
+
 def main(fn):
     os.chdir(os.path.split(fn)[0])
 
     cue_.probe(fn)
     cue_.parse()
     cue_.modify()
+    if option_.reslice and not cue_.is_singlefile: reslice()
     if cue_.is_singlefile:
         cue_.lengths()
     if not option_.quiet: cue_.print_()
+    sink_.open()
     cue_.save()
 
-    if not option_.nowrite:
+    if option_.retag:
+        files_ = Files()
+        files_.retag()
+    elif not option_.nowrite:
         files_ = Files()
         files_.write()
         if not option_.nodelete: files_.rm()
 
     exit(exit_str)
 
+def reset():
+    """Drop the state left by processing the previous cuesheet"""
+    global sink_, meta_, aud_, cue_
+    sink_, meta_, aud_, cue_ = Sink(), Meta(), Audio(), Cue()
+
+def run(args):
+    """Process a cuesheet with the given command line, replacing the state
+    left by the previous run"""
+    global argv_, option_
+    argv_ = Argv(args)
+    option_ = argv_.opts
+    reset()
+    main(os.path.abspath(argv_.args[0]))
+
+def retag(cues):
+    failed = []
+    for fn in [os.path.abspath(x) for x in cues]:
+        pollute('\n%s\n' % fn)
+        if not os.path.isfile(fn):
+            pollute('ERROR: No such file: "%s"\n' % fn, 1)
+            failed.append(fn)
+            continue
+        reset()
+        # a previous cuesheet may have left it at any of the formats
+        argv_.format = argv_.formats[0]
+        try:
+            main(fn)
+        except SystemExit, err:
+            if err.code: failed.append(fn)
+    if failed:
+        exit('Failed to retag %i of %i cuesheets:\n%s\n' % (len(failed),
+            len(cues), '\n'.join(failed)), 1)
+    exit(exit_str)
+
 if __name__ == '__main__':
-    cuename = os.path.abspath(argv_.args[0])
-    main(cuename)
+    if option_.serve:
+        Server().loop()
+    elif option_.check:
+        audit(option_.check)
+    elif option_.retag:
+        retag(argv_.args)
+    else:
+        cuename = os.path.abspath(argv_.args[0])
+        main(cuename)